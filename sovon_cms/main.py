@@ -1,12 +1,12 @@
 import argparse
+import collections
+import functools
 import logging
+import operator
 import os
 import os.path as path
 import re
-import shutil
-
-import markdown as md
-from jinja2 import Environment as JinjaEnv, FileSystemLoader as JinjaFSLoader
+import stat
 
 from sovon_cms.version import __version__
 
@@ -30,11 +30,18 @@ MARKDOWN_EXTENSION_CONFIGS = {'markdown_katex': {'no_inline_svg': True,  # fix f
 MARKDOWN_TEMPLATE = '_markdown.html'
 INDEX_TEMPLATE = '_index.html'
 
+DOCUMENT_KINDS = {'.md': 'markdown',
+                  '.html': 'html',
+                  '.htm': 'html',
+                  }
+
+_FILENAME_RE = re.compile(r'(\d+)[\-._](.+)')
+
 
 def parse_file_name(file_name):
-    p = re.match(r'(\d+)[\-\._](.+)', file_name)
-    if p:
-        index, title = int(p.groups()[0]), p.groups()[1]
+    m = _FILENAME_RE.match(file_name)
+    if m:
+        index, title = int(m.group(1)), m.group(2)
     else:
         index, title = MAX_INDEX, file_name
 
@@ -42,6 +49,10 @@ def parse_file_name(file_name):
     return index, title
 
 
+def md_to_html(file_name):
+    return file_name[:-3] + '.html' if file_name[-3:].lower() == '.md' else file_name
+
+
 def read_file(file_path) -> str:
     with open(file_path, 'r', encoding='utf-8') as f:
         return f.read()
@@ -52,27 +63,87 @@ def write_file(file_path, content):
         f.write(content)
 
 
+_markdown = None
+
+
+def _markdown_to_html(s) -> str:
+    global _markdown
+
+    # extensions are loaded once per process, reset() clears the state of the previous document
+    if _markdown is None:
+        from markdown import Markdown
+        _markdown = Markdown(extensions=MARKDOWN_EXTENSIONS, extension_configs=MARKDOWN_EXTENSION_CONFIGS)
+
+    return _markdown.reset().convert(s)
+
+
+def _cmarkgfm_to_html(s) -> str:
+    try:
+        import cmarkgfm
+        from cmarkgfm.cmark import Options as CmarkOptions
+    except ImportError:
+        raise ImportError('markdown engine "cmarkgfm" requires package cmarkgfm, '
+                          'install it with "pip install sovon-cms[cmarkgfm]"')
+
+    # keep raw html as python-markdown does
+    return cmarkgfm.github_flavored_markdown_to_html(s, options=CmarkOptions.CMARK_OPT_UNSAFE)
+
+
+# cmarkgfm is much faster but supports neither katex, toc anchors nor the "extra" syntax
+MARKDOWN_ENGINES = {'markdown': _markdown_to_html,
+                    'cmarkgfm': _cmarkgfm_to_html,
+                    }
+markdown_engine = 'markdown'
+
+
+def set_markdown_engine(name):
+    global markdown_engine
+
+    assert name in MARKDOWN_ENGINES, f'Unknown markdown engine "{name}"'
+    markdown_engine = name
+
+
+def render_markdown(s) -> str:
+    return MARKDOWN_ENGINES[markdown_engine](s)
+
+
 def parse_markdown(file_path) -> str:
     s = read_file(file_path)
-    r = md.markdown(s, extensions=MARKDOWN_EXTENSIONS, extension_configs=MARKDOWN_EXTENSION_CONFIGS)
+    r = render_markdown(s)
     return r
 
 
+@functools.lru_cache(maxsize=None)
+def get_jinja_env(root_path):
+    from jinja2 import Environment as JinjaEnv, FileSystemLoader as JinjaFSLoader
+
+    # one environment per template directory, compiled templates are kept until the next render_site call
+    return JinjaEnv(loader=JinjaFSLoader(root_path), auto_reload=False, cache_size=-1)
+
+
+def get_template(file_path):
+    root_path, template_name = path.split(file_path)
+    return get_jinja_env(root_path).get_template(template_name)
+
+
 def parse_jinja(file_path, **kwargs):
-    root_path, template = path.split(file_path)
-    env = JinjaEnv(loader=JinjaFSLoader(root_path))
-    r = env.get_template(template).render(**kwargs)
+    r = get_template(file_path).render(**kwargs)
     return r
 
 
 class Document(object):
-    def __init__(self, file_path):
-        assert path.exists(file_path)
+    __slots__ = ('file_path', 'modified_time', 'kind', 'is_markdown', 'is_html', 'index', 'title',
+                 'content_', 'html_')
+
+    def __init__(self, file_path, modified_time=None):
+        if modified_time is None:
+            modified_time = os.stat(file_path).st_mtime  # raises FileNotFoundError if not found
 
         self.file_path = file_path
-        self.modified_time = os.stat(file_path).st_mtime
-        self.is_markdown = file_path.endswith('.md')
-        self.is_html = file_path.endswith('.html') or file_path.endswith('.htm')
+        self.modified_time = modified_time
+        self.kind = DOCUMENT_KINDS.get(path.splitext(file_path)[1].lower())
+        self.is_markdown = self.kind == 'markdown'
+        self.is_html = self.kind == 'html'
 
         dir_path, file_name = path.split(file_path)
         if self.is_markdown:
@@ -80,18 +151,27 @@ class Document(object):
         else:
             self.index, self.title = None, file_name
 
+        # cached items
+        self.content_ = None
+        self.html_ = None
+
     @property
     def summary(self) -> str:
         raise NotImplementedError()
 
     @property
     def content(self) -> str:
-        return read_file(self.file_path)
+        if self.content_ is None:
+            self.content_ = read_file(self.file_path)
+
+        return self.content_
 
     @property
     def html(self) -> str:
         if self.is_markdown:
-            return md.markdown(self.content, extensions=MARKDOWN_EXTENSIONS)
+            if self.html_ is None:
+                self.html_ = render_markdown(self.content)
+            return self.html_
         else:
             raise ValueError(f'"html" is not supported for file {self.title}')
 
@@ -99,7 +179,7 @@ class Document(object):
     def href(self):
         _, file_name = path.split(self.file_path)
         if self.is_markdown:
-            file_name = re.sub(r'\.md$', '.html', file_name)
+            file_name = md_to_html(file_name)
         return file_name
 
     def __repr__(self) -> str:
@@ -107,6 +187,9 @@ class Document(object):
 
 
 class Category(object):
+    __slots__ = ('dir_path', 'index', 'title', 'document_template', 'index_template', 'parent', 'uri',
+                 'documents_', 'children_', 'modified_time_', 'markdown_documents_', 'has_html_')
+
     def __init__(self, dir_path, index=None, title=None, parent=None):
         self.dir_path = dir_path
 
@@ -130,19 +213,14 @@ class Category(object):
             self.index_template = index_template if path.exists(index_template) else None
 
         self.parent = parent
+        self.uri = f'{parent.uri}/{path.basename(dir_path)}' if parent is not None else ''
 
         # cached items
         self.documents_ = None
         self.children_ = None
         self.modified_time_ = None
-
-    @property
-    def uri(self):
-        _, category_dir = path.split(self.dir_path)
-        if self.parent is not None:
-            return f'{self.parent.uri}/{category_dir}'
-        else:
-            return ''
+        self.markdown_documents_ = None
+        self.has_html_ = None
 
     @property
     def modified_time(self):
@@ -155,111 +233,254 @@ class Category(object):
 
         return self.modified_time_
 
+    def _scan(self):
+        documents = []
+        sub_dirs = []
+        with os.scandir(self.dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    sub_dirs.append(entry.path)
+                elif entry.is_file() and entry.name not in {INDEX_TEMPLATE, MARKDOWN_TEMPLATE}:
+                    # the stat result is cached by the entry, is_file() may have fetched it already
+                    documents.append(Document(entry.path, modified_time=entry.stat().st_mtime))
+        sub_dirs.sort()
+
+        markdown_documents = [doc for doc in documents if doc.is_markdown]
+        # markdown documents always have an index, MAX_INDEX if not specified in the file name
+        markdown_documents.sort(key=operator.attrgetter('index'),
+                                reverse=all(doc.index > REVERSE_SORT_INDEX for doc in markdown_documents))
+
+        self.documents_ = documents
+        self.markdown_documents_ = markdown_documents
+        self.children_ = [Category(sub, parent=self) for sub in sub_dirs]
+
     @property
     def documents(self) -> list:
         if self.documents_ is None:
-            sub_dirs = [path.join(self.dir_path, p) for p in os.listdir(self.dir_path)
-                        if p not in {INDEX_TEMPLATE, MARKDOWN_TEMPLATE}]
-            sub_dirs = filter(path.isfile, sub_dirs)
-            self.documents_ = list(map(Document, sub_dirs))
+            self._scan()
 
         return self.documents_
 
     @property
     def children(self) -> list:
         if self.children_ is None:
-            sub_dirs = [path.join(self.dir_path, p) for p in os.listdir(self.dir_path)]
-            sub_dirs.sort()
-            sub_dirs = filter(path.isdir, sub_dirs)
-            self.children_ = [Category(sub, parent=self) for sub in sub_dirs]
+            self._scan()
 
         return self.children_
 
+    def compile_templates(self):
+        # compiled templates are kept by the jinja environments, forked worker processes inherit them
+        for template in (self.document_template, self.index_template):
+            if template is not None:
+                get_template(template)
+
+    @property
+    def markdown_documents(self) -> list:
+        if self.markdown_documents_ is None:
+            self._scan()
+
+        return self.markdown_documents_
+
     @property
     def has_html(self):
-        return any(doc.is_markdown or doc.is_html for doc in self.documents)
+        if self.has_html_ is None:
+            self.has_html_ = any(doc.kind is not None for doc in self.documents) \
+                             or any(child.has_html for child in self.children)
+
+        return self.has_html_
 
     def __repr__(self) -> str:
         return f'{self.__class__.__name__}(index={self.index}, title="{self.title}")'
 
 
-def is_ready(output_path, time_stamp):
-    return os.path.exists(output_path) and os.stat(output_path).st_mtime > time_stamp
+def is_ready(output_path, time_stamp, strict=True):
+    if not os.path.exists(output_path):
+        return False
 
+    output_time = os.stat(output_path).st_mtime
+    return output_time > time_stamp if strict else output_time >= time_stamp
 
-def render_site(root_dir, output_dir):
+
+def render_site(root_dir, output_dir, jobs=None, engine='markdown'):
     root_dir = path.abspath(path.expanduser(root_dir))
     output_dir = path.abspath(path.expanduser(output_dir))
-    assert path.exists(root_dir), f'Not found path {root_dir}'
-    assert path.isdir(root_dir), f'Root path should be a directory'
-    if not path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
-    else:
-        assert path.isdir(output_dir), f'Output path should be a directory'
+    # raises FileNotFoundError if not found
+    assert stat.S_ISDIR(os.stat(root_dir).st_mode), f'Root path should be a directory'
+    # raises FileExistsError if output_dir is a file
+    os.makedirs(output_dir, exist_ok=True)
+
+    set_markdown_engine(engine)
+
+    # templates may have changed since the last build in this process
+    get_jinja_env.cache_clear()
 
     logger.info(f'render site from "{root_dir}" to "{output_dir}"')
     root = Category(root_dir, 0, 'ROOT')
-    render_category(root, root, output_dir)
+    tasks = []
+    collect_tasks(root, root, output_dir, tasks)
+    render_tasks(root, tasks, jobs)
     logger.info('done')
 
 
 def render_category(root: Category, category: Category, output_dir: str):
-    # logger.info(f'[{category.title}] rendering ...')
-
-    if not path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
-
-    children = category.children
-    documents = category.documents
-    index_template = category.index_template
-    markdown_template = category.document_template
-
-    children_with_html = [cat for cat in children if cat.has_html]
-    markdown_documents = [doc for doc in documents if doc.is_markdown]
-    markdown_documents.sort(key=lambda doc: doc.index if doc.index is not None else MAX_INDEX,
-                            reverse=all([doc.index is not None and doc.index > REVERSE_SORT_INDEX
-                                         for doc in markdown_documents]))
-
-    counter = 0
-    if index_template is not None and len(markdown_documents) > 0:
-        output_path = path.join(output_dir, 'index.html')
-        if not is_ready(output_path, category.modified_time):
+    tasks = []
+    counter = collect_tasks(root, category, output_dir, tasks)
+    render_tasks(root, tasks, jobs=1)
+    return counter
+
+
+def collect_tasks(root: Category, category: Category, output_dir: str, tasks: list):
+    """
+    Walk the category tree, collect (kind, category, document, output_path) items to be rendered into `tasks`.
+    The kind is a key of DOCUMENT_RENDERERS, the document is None for the category index page.
+    """
+    path_join = path.join
+    path_split = path.split
+
+    visited = []
+    queue = collections.deque([(category, output_dir)])
+    while queue:
+        current, current_dir = queue.popleft()
+        # logger.info(f'[{current.title}] rendering ...')
+
+        os.makedirs(current_dir, exist_ok=True)
+
+        index_template = current.index_template
+        markdown_template = current.document_template
+
+        # rendered pages depend on all documents of the category and on their template
+        modified_time = current.modified_time
+        markdown_modified_time = max(modified_time, os.stat(markdown_template).st_mtime) \
+            if markdown_template else modified_time
+
+        counter = 0
+        file_names = set()
+        for document in current.documents:
+            _, file_name = path_split(document.file_path)
+            kind = document.kind or 'copy'
+            if kind == 'markdown' and not markdown_template:
+                kind = 'copy'  # no template to render it with
+            if kind == 'markdown':
+                file_name = md_to_html(file_name)
+            file_names.add(file_name)
+            output_path = path_join(current_dir, file_name)
+
+            if kind == 'markdown':
+                ready = is_ready(output_path, markdown_modified_time)
+            elif kind == 'html':
+                ready = is_ready(output_path, modified_time)
+            else:
+                # copied with its modification time, see copy_document
+                ready = is_ready(output_path, document.modified_time, strict=False)
+
+            if ready:
+                continue  # skip
+
             logger.info(f'updating {output_path}')
-            content = parse_jinja(index_template, documents=markdown_documents, children=children,
-                                  root=root, category=category)
-            write_file(output_path, content)
+            tasks.append((kind, current, document, output_path))
             counter += 1
 
-    for document in documents:
-        _, file_name = path.split(document.file_path)
-        output_path = path.join(output_dir, file_name)
-        if document.is_markdown and markdown_template:
-            output_path = re.sub(r'\.md$', '.html', output_path)
-
-        if is_ready(output_path, category.modified_time):
-            continue  # skip
-
-        logger.info(f'updating {output_path}')
-        if document.is_markdown and markdown_template:
-            content = parse_jinja(markdown_template, documents=markdown_documents, children=children_with_html,
-                                  root=root, document=document, category=category)
-            write_file(output_path, content)
-        elif document.is_html:
-            content = parse_jinja(document.file_path, documents=markdown_documents, children=children_with_html,
-                                  root=root, category=category)
-            write_file(output_path, content)
-        else:
-            shutil.copy(document.file_path, output_path)
-        counter += 1
+        # categories with html, even if only in sub categories, are listed in menus and need an index page,
+        # unless one of their own documents is the index page already
+        if current.has_html and index_template is not None and 'index.html' not in file_names:
+            output_path = path_join(current_dir, 'index.html')
+            if not is_ready(output_path, max(modified_time, os.stat(index_template).st_mtime)):
+                logger.info(f'updating {output_path}')
+                tasks.append(('index', current, None, output_path))
+                counter += 1
 
-    for child in children:
-        _, child_dir = path.split(child.dir_path)
-        counter += render_category(root, child, path.join(output_dir, child_dir))
+        if counter > 0:
+            current.compile_templates()
+        visited.append((current, counter))
+        for child in current.children:
+            _, child_dir = path_split(child.dir_path)
+            queue.append((child, path_join(current_dir, child_dir)))
 
-    if counter > 0:
-        logger.info(f'[{category.title}] update {counter} documents')
+    # sum up counters from the deepest categories to the top one
+    totals = {}
+    for current, counter in reversed(visited):
+        counter += sum(totals[child.dir_path] for child in current.children)
+        totals[current.dir_path] = counter
+        if counter > 0:
+            logger.info(f'[{current.title}] update {counter} documents')
+
+    return totals[category.dir_path]
+
+
+def render_index(root: Category, category: Category, document, output_path: str):
+    content = parse_jinja(category.index_template, documents=category.markdown_documents,
+                          children=category.children, root=root, category=category)
+    write_file(output_path, content)
+
+
+def render_markdown_document(root: Category, category: Category, document: Document, output_path: str):
+    children_with_html = [cat for cat in category.children if cat.has_html]
+    content = parse_jinja(category.document_template, documents=category.markdown_documents,
+                          children=children_with_html, root=root, document=document, category=category)
+    write_file(output_path, content)
 
-    return counter
+
+def render_html_document(root: Category, category: Category, document: Document, output_path: str):
+    children_with_html = [cat for cat in category.children if cat.has_html]
+    content = parse_jinja(document.file_path, documents=category.markdown_documents,
+                          children=children_with_html, root=root, category=category)
+    write_file(output_path, content)
+
+
+def copy_document(root: Category, category: Category, document: Document, output_path: str):
+    import shutil
+
+    shutil.copy2(document.file_path, output_path)
+
+
+DOCUMENT_RENDERERS = {'index': render_index,
+                      'markdown': render_markdown_document,
+                      'html': render_html_document,
+                      'copy': copy_document,
+                      }
+
+
+def render_tasks(root: Category, tasks: list, jobs=None):
+    if (jobs is not None and jobs <= 1) or len(tasks) <= 1:
+        for kind, category, document, output_path in tasks:
+            DOCUMENT_RENDERERS[kind](root, category, document, output_path)
+        return
+
+    import concurrent.futures
+
+    # only paths are sent to the workers, they receive the category tree once from the initializer
+    items = [(kind, category.dir_path, document.file_path if document is not None else None, output_path)
+             for kind, category, document, output_path in tasks]
+    # None lets the executor use the number of CPUs, within the limits of the platform
+    max_workers = min(jobs, len(tasks)) if jobs is not None else None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                                initargs=(root, markdown_engine)) as executor:
+        for _ in executor.map(_render_one, items, chunksize=8):
+            pass
+
+
+_worker_root = None
+_worker_categories = {}
+_worker_documents = {}
+
+
+def _init_worker(root: Category, engine: str):
+    global _worker_root
+
+    set_markdown_engine(engine)
+    _worker_root = root
+    categories = [root]
+    while categories:
+        category = categories.pop()
+        _worker_categories[category.dir_path] = category
+        _worker_documents.update((doc.file_path, doc) for doc in category.documents)
+        categories.extend(category.children)
+
+
+def _render_one(item):
+    kind, dir_path, file_path, output_path = item
+    document = _worker_documents[file_path] if file_path is not None else None
+    DOCUMENT_RENDERERS[kind](_worker_root, _worker_categories[dir_path], document, output_path)
 
 
 def run():
@@ -267,15 +488,23 @@ def run():
     parser.add_argument('--output-dir', type=str, default='dist',
                         help='')
     parser.add_argument('--version', '-v', action='store_true', default=False)
-    parser.add_argument('--root-dir', type=str, required=True,
+    parser.add_argument('--root-dir', type=str, default=None,
                         help='')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of rendering processes, default to the number of CPUs')
+    parser.add_argument('--markdown-engine', type=str, default='markdown', choices=sorted(MARKDOWN_ENGINES.keys()),
+                        help='library to convert markdown documents, "cmarkgfm" is faster but without katex and toc')
 
     args = parser.parse_args()
 
     if args.version:
         print('version: ', __version__)
+        return
+
+    if args.root_dir is None:
+        parser.error('the following arguments are required: --root-dir')
 
-    render_site(args.root_dir, args.output_dir)
+    render_site(args.root_dir, args.output_dir, jobs=args.jobs, engine=args.markdown_engine)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,162 @@
 def test_import():
     from sovon_cms import main
     print('version:', main.__version__)
+
+
+def test_parse_file_name():
+    from sovon_cms.main import parse_file_name, MAX_INDEX
+
+    assert parse_file_name('01-hello.md') == (1, 'hello')
+    assert parse_file_name('2_world.md') == (2, 'world')
+    assert parse_file_name('10.intro.md') == (10, 'intro')
+    assert parse_file_name('readme.md') == (MAX_INDEX, 'readme')
+
+
+def test_render_site(tmp_path):
+    from sovon_cms.main import render_site
+
+    root_dir = tmp_path / 'site'
+    output_dir = tmp_path / 'dist'
+    (root_dir / '01-sub').mkdir(parents=True)
+    (root_dir / 'about.html').write_text('<p>{{ category.title }}</p>')
+    (root_dir / 'logo.png').write_bytes(b'png')
+    (root_dir / '01-sub' / 'page.html').write_text('<p>{{ category.uri }}</p>')
+
+    render_site(str(root_dir), str(output_dir), jobs=1)
+
+    assert (output_dir / 'about.html').read_text() == '<p>ROOT</p>'
+    assert (output_dir / 'logo.png').read_bytes() == b'png'
+    assert (output_dir / '01-sub' / 'page.html').read_text() == '<p>/01-sub</p>'
+
+
+def test_render_site_twice(tmp_path):
+    import os
+    import time
+    from sovon_cms.main import render_site
+
+    root_dir = tmp_path / 'site'
+    output_dir = tmp_path / 'dist'
+    root_dir.mkdir()
+    page = root_dir / 'page.html'
+
+    page.write_text('v1 {{ category.title }}')
+    render_site(str(root_dir), str(output_dir), jobs=1)
+    assert (output_dir / 'page.html').read_text() == 'v1 ROOT'
+
+    page.write_text('v2 {{ category.title }}')
+    future = time.time() + 100
+    os.utime(page, (future, future))
+    render_site(str(root_dir), str(output_dir), jobs=1)
+    assert (output_dir / 'page.html').read_text() == 'v2 ROOT'
+
+
+def test_markdown_engines(tmp_path):
+    import pytest
+    from sovon_cms.main import render_site
+
+    root_dir = tmp_path / 'site'
+    root_dir.mkdir()
+    (root_dir / '_markdown.html').write_text('{{ document.html }}')
+    (root_dir / '01-hello.md').write_text('# Hello\n\nText[^1]\n\n[^1]: note\n')
+
+    render_site(str(root_dir), str(tmp_path / 'markdown'), jobs=1)
+    html = (tmp_path / 'markdown' / '01-hello.html').read_text()
+    assert '<h1 id="hello">Hello</h1>' in html
+    assert 'class="footnote"' in html
+
+    pytest.importorskip('cmarkgfm')
+    render_site(str(root_dir), str(tmp_path / 'cmarkgfm'), jobs=1, engine='cmarkgfm')
+    html = (tmp_path / 'cmarkgfm' / '01-hello.html').read_text()
+    assert '<h1>Hello</h1>' in html
+
+    # the engine is not kept from the previous call
+    render_site(str(root_dir), str(tmp_path / 'default'), jobs=1)
+    html = (tmp_path / 'default' / '01-hello.html').read_text()
+    assert '<h1 id="hello">Hello</h1>' in html
+
+
+def test_render_site_jobs(tmp_path):
+    from sovon_cms.main import render_site
+
+    root_dir = tmp_path / 'site'
+    output_dir = tmp_path / 'dist'
+    (root_dir / '01-sub').mkdir(parents=True)
+    (root_dir / '_markdown.html').write_text('<title>{{ document.title }}</title>{{ document.html }}')
+    (root_dir / '_index.html').write_text('{% for doc in documents %}[{{ doc.href }}]{% endfor %}')
+    (root_dir / '01-hello.md').write_text('# Hello')
+    (root_dir / '02-world.md').write_text('# World')
+    (root_dir / '01-sub' / '01-page.md').write_text('# Page')
+    (root_dir / 'about.html').write_text('<p>{{ category.title }}</p>')
+
+    render_site(str(root_dir), str(output_dir), jobs=2)
+
+    assert (output_dir / 'index.html').read_text() == '[01-hello.html][02-world.html]'
+    assert (output_dir / '01-hello.html').read_text() == '<title>hello</title><h1 id="hello">Hello</h1>'
+    assert (output_dir / '02-world.html').read_text() == '<title>world</title><h1 id="world">World</h1>'
+    assert (output_dir / 'about.html').read_text() == '<p>ROOT</p>'
+    assert (output_dir / '01-sub' / 'index.html').read_text() == '[01-page.html]'
+    assert (output_dir / '01-sub' / '01-page.html').read_text() == '<title>page</title><h1 id="page">Page</h1>'
+
+
+def test_render_site_nested_category(tmp_path):
+    from sovon_cms.main import render_site
+
+    root_dir = tmp_path / 'site'
+    output_dir = tmp_path / 'dist'
+    (root_dir / '01-a' / '02-deep').mkdir(parents=True)
+    (root_dir / '02-no-html').mkdir()
+    (root_dir / '_markdown.html').write_text('{% for cat in children %}[{{ cat.title }}]{% endfor %}')
+    (root_dir / '_index.html').write_text('{% for cat in children %}<{{ cat.title }}>{% endfor %}')
+    (root_dir / '01-hello.md').write_text('# Hello')
+    (root_dir / '01-a' / '02-deep' / '05-x.md').write_text('# X')
+    (root_dir / '02-no-html' / 'logo.png').write_bytes(b'png')
+
+    render_site(str(root_dir), str(output_dir), jobs=1)
+
+    # "a" has html in a sub category only, it is listed in menus and gets an index page to link to
+    assert (output_dir / '01-hello.html').read_text() == '[a]'
+    assert (output_dir / '01-a' / 'index.html').read_text() == '<deep>'
+    assert (output_dir / '01-a' / '02-deep' / 'index.html').exists()
+    assert not (output_dir / '02-no-html' / 'index.html').exists()
+
+
+def test_render_site_incremental(tmp_path):
+    import os
+    import time
+    from sovon_cms.main import render_site
+
+    root_dir = tmp_path / 'site'
+    output_dir = tmp_path / 'dist'
+    root_dir.mkdir()
+    (root_dir / '_markdown.html').write_text('{{ document.html }}')
+    (root_dir / '_index.html').write_text('{% for doc in documents %}[{{ doc.href }}]{% endfor %}')
+    (root_dir / '01-hello.md').write_text('# Hello')
+    (root_dir / 'about.html').write_text('<p>{{ category.title }}</p>')
+    (root_dir / 'logo.png').write_bytes(b'png')
+
+    # sources are older than anything rendered below, whatever the file system time resolution
+    past = time.time() - 1000
+    for p in root_dir.iterdir():
+        os.utime(p, (past, past))
+
+    def output_times():
+        return {p.name: p.stat().st_mtime_ns for p in output_dir.iterdir()}
+
+    render_site(str(root_dir), str(output_dir), jobs=1)
+    first = output_times()
+    assert sorted(first) == ['01-hello.html', 'about.html', 'index.html', 'logo.png']
+    # static files are copied with their modification time
+    assert first['logo.png'] == (root_dir / 'logo.png').stat().st_mtime_ns
+
+    # nothing changed, nothing rendered
+    render_site(str(root_dir), str(output_dir), jobs=1)
+    assert output_times() == first
+
+    # a newer document template re-renders the markdown pages only
+    future = time.time() + 1000
+    os.utime(root_dir / '_markdown.html', (future, future))
+    render_site(str(root_dir), str(output_dir), jobs=1)
+    third = output_times()
+    assert third['01-hello.html'] != first['01-hello.html']
+    assert {k: v for k, v in third.items() if k != '01-hello.html'} == \
+           {k: v for k, v in first.items() if k != '01-hello.html'}